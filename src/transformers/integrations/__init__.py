@@ -56,6 +56,8 @@ _import_structure = {
     "fbgemm_fp8": ["FbgemmFp8Linear", "FbgemmFp8Llama4TextExperts", "replace_with_fbgemm_fp8_linear"],
     "finegrained_fp8": ["FP8Linear", "replace_with_fp8_linear"],
     "fsdp": ["is_fsdp_managed_module"],
+    "fused_rotary": ["fused_apply_rotary_pos_emb_interleave", "is_fused_rotary_available"],
+    "fused_swiglu": ["fused_silu_mul", "is_fused_swiglu_available"],
     "ggml": [
         "GGUF_CONFIG_MAPPING",
         "GGUF_TOKENIZER_MAPPING",
@@ -195,6 +197,8 @@ if TYPE_CHECKING:
     from .fbgemm_fp8 import FbgemmFp8Linear, FbgemmFp8Llama4TextExperts, replace_with_fbgemm_fp8_linear
     from .finegrained_fp8 import FP8Linear, replace_with_fp8_linear
     from .fsdp import is_fsdp_managed_module
+    from .fused_rotary import fused_apply_rotary_pos_emb_interleave, is_fused_rotary_available
+    from .fused_swiglu import fused_silu_mul, is_fused_swiglu_available
     from .ggml import (
         GGUF_CONFIG_MAPPING,
         GGUF_TOKENIZER_MAPPING,
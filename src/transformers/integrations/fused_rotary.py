@@ -0,0 +1,140 @@
+# coding=utf-8
+# Copyright 2025 The HuggingFace Inc. team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import Tuple
+
+from ..utils import is_torch_available, is_torchdynamo_compiling
+from ..utils.import_utils import is_triton_available
+
+
+if is_torch_available():
+    import torch
+
+if is_triton_available():
+    import triton
+    import triton.language as tl
+
+    @triton.jit
+    def _rotary_interleave_kernel(
+        X,
+        Out,
+        Cos,
+        Sin,
+        seq_len,
+        num_heads,
+        half_dim,
+        stride_xb,
+        stride_xh,
+        stride_xs,
+        stride_xd,
+        stride_ob,
+        stride_oh,
+        stride_os,
+        stride_od,
+        stride_cb,
+        stride_cs,
+        stride_cd,
+        BLOCK_H: tl.constexpr,
+        BLOCK_D: tl.constexpr,
+    ):
+        """
+        Rotates the `(x[2i], x[2i + 1])` pairs of a `(BLOCK_H, head_dim)` tile of heads sharing the same batch index
+        and position. Everything happens in registers, the tile is read and written exactly once.
+        """
+        # in int64, long prefills times the stride of a sequence position overflow int32 offsets
+        pid_bs = tl.program_id(axis=0).to(tl.int64)
+        pid_h = tl.program_id(axis=1)
+        batch_idx = pid_bs // seq_len
+        seq_idx = pid_bs % seq_len
+
+        offs_h = pid_h * BLOCK_H + tl.arange(0, BLOCK_H)
+        offs_d = tl.arange(0, BLOCK_D)
+        mask_d = offs_d < half_dim
+        mask = (offs_h[:, None] < num_heads) & mask_d[None, :]
+
+        # cos and sin are shared by all heads, the broadcast happens here instead of being materialized
+        cs_offs = batch_idx * stride_cb + seq_idx * stride_cs + offs_d * stride_cd
+        cos = tl.load(Cos + cs_offs, mask=mask_d, other=0.0).to(tl.float32)[None, :]
+        sin = tl.load(Sin + cs_offs, mask=mask_d, other=0.0).to(tl.float32)[None, :]
+
+        x_ptrs = X + batch_idx * stride_xb + seq_idx * stride_xs + offs_h[:, None] * stride_xh
+        x_even = tl.load(x_ptrs + (2 * offs_d[None, :]) * stride_xd, mask=mask, other=0.0).to(tl.float32)
+        x_odd = tl.load(x_ptrs + (2 * offs_d[None, :] + 1) * stride_xd, mask=mask, other=0.0).to(tl.float32)
+
+        out_ptrs = Out + batch_idx * stride_ob + seq_idx * stride_os + offs_h[:, None] * stride_oh
+        out_even = (x_even * cos - x_odd * sin).to(Out.dtype.element_ty)
+        out_odd = (x_odd * cos + x_even * sin).to(Out.dtype.element_ty)
+        tl.store(out_ptrs + (2 * offs_d[None, :]) * stride_od, out_even, mask=mask)
+        tl.store(out_ptrs + (2 * offs_d[None, :] + 1) * stride_od, out_odd, mask=mask)
+
+
+def _rotary_interleave(x: "torch.Tensor", cos: "torch.Tensor", sin: "torch.Tensor") -> "torch.Tensor":
+    batch_size, num_heads, seq_len, head_dim = x.shape
+    out = torch.empty(x.shape, dtype=x.dtype, device=x.device)
+    # cos and sin are interleaved as well, the i-th pair frequency is repeated at `2i` and `2i + 1`
+    cos_stride_b = cos.stride(0) if cos.shape[0] > 1 else 0
+    block_h = min(triton.next_power_of_2(num_heads), 16)
+    grid = (batch_size * seq_len, triton.cdiv(num_heads, block_h))
+    # the kernel is launched on the current device, which may not be the one of `x` (e.g. with `device_map="auto"`)
+    with torch.cuda.device(x.device):
+        _rotary_interleave_kernel[grid](
+            x,
+            out,
+            cos,
+            sin,
+            seq_len,
+            num_heads,
+            head_dim // 2,
+            *x.stride(),
+            *out.stride(),
+            cos_stride_b,
+            cos.stride(1),
+            2 * cos.stride(2),
+            BLOCK_H=block_h,
+            BLOCK_D=triton.next_power_of_2(head_dim // 2),
+        )
+    return out
+
+
+def is_fused_rotary_available(q: "torch.Tensor", k: "torch.Tensor") -> bool:
+    """
+    Whether the fused kernel can be used for `q` and `k`. The kernel has no backward, so it is limited to inference.
+    """
+    return (
+        is_triton_available()
+        and q.is_cuda
+        and not is_torchdynamo_compiling()
+        and not (torch.is_grad_enabled() and (q.requires_grad or k.requires_grad))
+    )
+
+
+def fused_apply_rotary_pos_emb_interleave(
+    q: "torch.Tensor", k: "torch.Tensor", cos: "torch.Tensor", sin: "torch.Tensor"
+) -> Tuple["torch.Tensor", "torch.Tensor"]:
+    """
+    Fused counterpart of the interleaved rotary embedding used by DeepSeek-V3: a single kernel per tensor reads the
+    interleaved pairs, rotates them and writes the result, instead of the `rotate_pairs` gather and elementwise ops.
+
+    Args:
+        q (`torch.Tensor`): The query tensor, of shape `(batch_size, num_heads, seq_len, head_dim)`.
+        k (`torch.Tensor`): The key tensor, of shape `(batch_size, num_key_value_heads, seq_len, head_dim)`.
+        cos (`torch.Tensor`):
+            The interleaved cosine part of the rotary embedding, of shape `(batch_size, seq_len, head_dim)`.
+        sin (`torch.Tensor`):
+            The interleaved sine part of the rotary embedding, of shape `(batch_size, seq_len, head_dim)`.
+    Returns:
+        `tuple(torch.Tensor)` comprising of the query and key tensors rotated using the Rotary Position Embedding.
+    """
+    return _rotary_interleave(q, cos, sin), _rotary_interleave(k, cos, sin)
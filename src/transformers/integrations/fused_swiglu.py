@@ -0,0 +1,73 @@
+# coding=utf-8
+# Copyright 2025 The HuggingFace Inc. team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from ..utils import is_torch_available, is_torchdynamo_compiling
+from ..utils.import_utils import is_triton_available
+
+
+if is_torch_available():
+    import torch
+
+if is_triton_available():
+    import triton
+    import triton.language as tl
+
+    @triton.jit
+    def _silu_mul_kernel(Gate, Up, Out, n_elements, BLOCK_SIZE: tl.constexpr):
+        """
+        Computes `silu(gate) * up` on a block of contiguous elements, in registers and in a single pass.
+        """
+        # in int64, long prefills times a large intermediate size overflow int32 offsets
+        offsets = tl.program_id(axis=0).to(tl.int64) * BLOCK_SIZE + tl.arange(0, BLOCK_SIZE)
+        mask = offsets < n_elements
+        gate = tl.load(Gate + offsets, mask=mask, other=0.0).to(tl.float32)
+        up = tl.load(Up + offsets, mask=mask, other=0.0).to(tl.float32)
+        out = gate * tl.sigmoid(gate) * up
+        tl.store(Out + offsets, out.to(Out.dtype.element_ty), mask=mask)
+
+
+def is_fused_swiglu_available(gate: "torch.Tensor", up: "torch.Tensor") -> bool:
+    """
+    Whether the fused kernel can be used for `gate` and `up`. The kernel has no backward, so it is limited to
+    inference.
+    """
+    return (
+        is_triton_available()
+        and gate.is_cuda
+        and not is_torchdynamo_compiling()
+        and not (torch.is_grad_enabled() and (gate.requires_grad or up.requires_grad))
+    )
+
+
+def fused_silu_mul(gate: "torch.Tensor", up: "torch.Tensor") -> "torch.Tensor":
+    """
+    Fused counterpart of `silu(gate) * up`, the gating of SwiGLU MLPs: a single kernel reads both projections and
+    writes the product, instead of materializing `silu(gate)` in between.
+
+    Args:
+        gate (`torch.Tensor`): The output of the gate projection, of shape `(..., intermediate_size)`.
+        up (`torch.Tensor`): The output of the up projection, with the same shape as `gate`.
+    Returns:
+        `torch.Tensor`: `silu(gate) * up`, with the same shape and dtype as `gate`.
+    """
+    gate = gate.contiguous()
+    up = up.contiguous()
+    out = torch.empty_like(gate)
+    n_elements = gate.numel()
+    block_size = 1024
+    # the kernel is launched on the current device, which may not be the one of `gate` (e.g. with `device_map="auto"`)
+    with torch.cuda.device(gate.device):
+        _silu_mul_kernel[(triton.cdiv(n_elements, block_size),)](gate, up, out, n_elements, BLOCK_SIZE=block_size)
+    return out
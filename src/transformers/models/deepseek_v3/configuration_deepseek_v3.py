@@ -119,6 +119,19 @@ class DeepseekV3Config(PretrainedConfig):
             Whether to use a bias in the query, key, value and output projection layers during self-attention.
         attention_dropout (`float`, *optional*, defaults to 0.0):
             The dropout ratio for the attention probabilities.
+        use_mla_absorption (`bool`, *optional*, defaults to `False`):
+            Whether to only cache the compressed key/value latent (and the rotary key) instead of the full per-head
+            keys and values. When decoding (or extending a cache), the key and value up-projections of `kv_b_proj`
+            are then absorbed into the query and the attention output. Only supported with the eager and sdpa
+            attention implementations, a dynamic cache and an unquantized `kv_b_proj`.
+        compile_dense_layers (`bool`, *optional*, defaults to `False`):
+            Whether to wrap the normalization, residual additions and MLP of the first `first_k_dense_replace` (dense)
+            decoder layers with `torch.compile`, so that their elementwise ops get fused. MoE layers are not compiled.
+        cuda_graph_decode (`bool`, *optional*, defaults to `False`):
+            Whether to capture the post-attention block of the dense decoder layers and the shared experts of the MoE
+            layers in CUDA graphs, replayed at every decoding step (single token, with cache and without gradients).
+            Attention and routed experts are left out as their shapes change from one step to the other. The graphs
+            are captured again once the weights are moved or reloaded.
 
     ```python
     >>> from transformers import DeepseekV3Model, DeepseekV3Config
@@ -189,6 +202,9 @@ class DeepseekV3Config(PretrainedConfig):
         rope_interleave=True,
         attention_bias=False,
         attention_dropout=0.0,
+        use_mla_absorption=False,
+        compile_dense_layers=False,
+        cuda_graph_decode=False,
         **kwargs,
     ):
         self.vocab_size = vocab_size
@@ -229,6 +245,9 @@ class DeepseekV3Config(PretrainedConfig):
         self.rope_scaling = rope_scaling
         self.attention_bias = attention_bias
         self.attention_dropout = attention_dropout
+        self.use_mla_absorption = use_mla_absorption
+        self.compile_dense_layers = compile_dense_layers
+        self.cuda_graph_decode = cuda_graph_decode
         # Validate the correctness of rotary position embeddings parameters
         # BC: if there is a 'type' field, copy it it to 'rope_type'.
         if self.rope_scaling is not None and "type" in self.rope_scaling:
@@ -1,5 +1,6 @@
 import math
-from typing import Callable, Optional, Tuple
+import weakref
+from typing import Callable, Dict, List, Optional, Tuple
 
 import torch
 import torch.nn.functional as F
@@ -8,10 +9,17 @@ from torch import nn
 
 from ...activations import ACT2FN
 from ...cache_utils import Cache
+from ...integrations import (
+    fused_apply_rotary_pos_emb_interleave,
+    fused_silu_mul,
+    is_fused_rotary_available,
+    is_fused_swiglu_available,
+)
 from ...modeling_flash_attention_utils import FlashAttentionKwargs
+from ...modeling_rope_utils import dynamic_rope_update
 from ...modeling_utils import ALL_ATTENTION_FUNCTIONS
 from ...processing_utils import Unpack
-from ...utils import logging
+from ...utils import is_torchdynamo_compiling, logging
 from ..llama.modeling_llama import (
     LlamaDecoderLayer,
     LlamaForCausalLM,
@@ -21,7 +29,6 @@ from ..llama.modeling_llama import (
     LlamaRotaryEmbedding,
     apply_rotary_pos_emb,
     eager_attention_forward,
-    rotate_half,
 )
 from .configuration_deepseek_v3 import DeepseekV3Config
 
@@ -34,14 +41,38 @@ class DeepseekV3RMSNorm(LlamaRMSNorm):
 
 
 class DeepseekV3RotaryEmbedding(LlamaRotaryEmbedding):
-    pass
+    @torch.no_grad()
+    @dynamic_rope_update  # power user: used with advanced RoPE types (e.g. dynamic rope)
+    def forward(self, x, position_ids):
+        inv_freq_expanded = self.inv_freq[None, :, None].float().expand(position_ids.shape[0], -1, 1).to(x.device)
+        position_ids_expanded = position_ids[:, None, :].float()
+
+        device_type = x.device.type if isinstance(x.device.type, str) and x.device.type != "mps" else "cpu"
+        with torch.autocast(device_type=device_type, enabled=False):  # Force float32
+            freqs = (inv_freq_expanded.float() @ position_ids_expanded.float()).transpose(1, 2)
+            if self.config.rope_interleave:
+                # match the interleaved layout of the rotary dims, so that the pairs don't need to be gathered
+                emb = torch.stack((freqs, freqs), dim=-1).flatten(-2)
+            else:
+                emb = torch.cat((freqs, freqs), dim=-1)
+            cos = emb.cos() * self.attention_scaling
+            sin = emb.sin() * self.attention_scaling
+
+        return cos.to(dtype=x.dtype), sin.to(dtype=x.dtype)
+
+
+def rotate_pairs(x):
+    """Rotates the interleaved `(x[2i], x[2i + 1])` pairs of the hidden dims of the input."""
+    x1 = x[..., 0::2]
+    x2 = x[..., 1::2]
+    return torch.stack((-x2, x1), dim=-1).flatten(-2)
 
 
 def apply_rotary_pos_emb_interleave(q, k, cos, sin, position_ids=None, unsqueeze_dim=1):
     r"""
-    TODO let's just use the original freqcis computation to not have the view
-    transpose + reshape! This is not optimized!
-    Applies Rotary Position Embedding to the query and key tensors.
+    Applies Rotary Position Embedding to the query and key tensors, rotating the interleaved `(x[2i], x[2i + 1])` pairs
+    of the original DeepSeek weights. `cos` and `sin` are expected in the matching interleaved layout, see
+    `DeepseekV3RotaryEmbedding`.
 
     Args:
         q (`torch.Tensor`): The query tensor.
@@ -61,17 +92,15 @@ def apply_rotary_pos_emb_interleave(q, k, cos, sin, position_ids=None, unsqueeze
     Returns:
         `tuple(torch.Tensor)` comprising of the query and key tensors rotated using the Rotary Position Embedding.
     """
-    cos = cos.unsqueeze(unsqueeze_dim)
-    sin = sin.unsqueeze(unsqueeze_dim)
-
-    b, h, s, d = q.shape
-    q = q.view(b, h, s, d // 2, 2).transpose(4, 3).reshape(b, h, s, d)
-
-    b, h, s, d = k.shape
-    k = k.view(b, h, s, d // 2, 2).transpose(4, 3).reshape(b, h, s, d)
-
-    q_embed = (q * cos) + (rotate_half(q) * sin)
-    k_embed = (k * cos) + (rotate_half(k) * sin)
+    if unsqueeze_dim == 1 and is_fused_rotary_available(q, k):
+        return fused_apply_rotary_pos_emb_interleave(q, k, cos, sin)
+
+    # no-op unless q has a different dtype than the hidden states (e.g. under autocast), in which case the
+    # (batch_size, seq_len, head_dim) tables are cast instead of promoting q and k
+    cos = cos.unsqueeze(unsqueeze_dim).to(q.dtype)
+    sin = sin.unsqueeze(unsqueeze_dim).to(q.dtype)
+    q_embed = (q * cos) + (rotate_pairs(q) * sin)
+    k_embed = (k * cos) + (rotate_pairs(k) * sin)
     return q_embed, k_embed
 
 
@@ -94,7 +123,12 @@ class DeepseekV3MLP(nn.Module):
         self.act_fn = ACT2FN[config.hidden_act]
 
     def forward(self, x):
-        down_proj = self.down_proj(self.act_fn(self.gate_proj(x)) * self.up_proj(x))
+        gate = self.gate_proj(x)
+        up = self.up_proj(x)
+        if self.config.hidden_act == "silu" and is_fused_swiglu_available(gate, up):
+            # silu and the product in a single pass over the `(..., intermediate_size)` activations
+            return self.down_proj(fused_silu_mul(gate, up))
+        down_proj = self.down_proj(self.act_fn(gate) * up)
         return down_proj
 
 
@@ -121,20 +155,20 @@ class DeepseekV3TopkRouter(nn.Module):
             .sum(dim=-1)
         )
         group_idx = torch.topk(group_scores, k=self.topk_group, dim=-1, sorted=False)[1]
-        group_mask = torch.zeros_like(group_scores)
-        group_mask.scatter_(1, group_idx, 1)
-        score_mask = (
-            group_mask.unsqueeze(-1)
-            .expand(-1, self.n_group, self.n_routed_experts // self.n_group)
-            .reshape(-1, self.n_routed_experts)
+        group_mask = torch.zeros_like(group_scores, dtype=torch.bool).scatter_(1, group_idx, True)
+        # mask the experts of the dropped groups in place, broadcasting the group mask instead of expanding it
+        scores_for_choice = (
+            scores_for_choice.view(-1, self.n_group, self.n_routed_experts // self.n_group)
+            .masked_fill_(~group_mask.unsqueeze(-1), float("-inf"))
+            .view(-1, self.n_routed_experts)
         )
-        scores_for_choice = scores_for_choice.masked_fill(~score_mask.bool(), 0.0)
         topk_indices = torch.topk(scores_for_choice, k=self.top_k, dim=-1, sorted=False)[1]
         return topk_indices
 
     def forward(self, hidden_states):
         hidden_states = hidden_states.view(-1, self.config.hidden_size)
-        router_logits = F.linear(hidden_states.type(torch.float32), self.weight.type(torch.float32))
+        # the projection runs in the input dtype, only the (small) logits are upcast for the sigmoid and top-k
+        router_logits = F.linear(hidden_states, self.weight.type(hidden_states.dtype)).float()
         scores = router_logits.sigmoid()
         topk_indices = self.get_topk_indices(scores)
         topk_weights = scores.gather(1, topk_indices)
@@ -145,45 +179,336 @@ class DeepseekV3TopkRouter(nn.Module):
         return topk_indices, topk_weights
 
 
-class DeepseekV3MoE(nn.Module):
+_SIDE_STREAMS = {}
+
+
+def _get_side_stream(device: torch.device) -> "torch.cuda.Stream":
+    # one side stream per device, shared by all the MoE layers
+    if device not in _SIDE_STREAMS:
+        _SIDE_STREAMS[device] = torch.cuda.Stream(device=device)
+    return _SIDE_STREAMS[device]
+
+
+def _can_use_grouped_mm(hidden_states: torch.Tensor) -> bool:
+    # `torch._grouped_mm` only ships bf16 CUTLASS kernels for sm90 (Hopper) devices. ROCm devices report a CUDA
+    # capability as well (e.g. (9, 4) for MI300), they go through the batched GEMMs or the expert loop instead
+    return (
+        hasattr(torch, "_grouped_mm")
+        and hidden_states.is_cuda
+        and torch.version.hip is None
+        and hidden_states.dtype == torch.bfloat16
+        and torch.cuda.get_device_capability(hidden_states.device) == (9, 0)
+    )
+
+
+_DECODE_GRAPHS = weakref.WeakKeyDictionary()
+_DECODE_GRAPH_POOLS = {}
+# decoding only sees a handful of batch sizes, past that the graphs of a module are captured again from scratch
+_MAX_DECODE_GRAPHS = 8
+
+
+def _can_use_decode_graph(hidden_states: torch.Tensor) -> bool:
+    # a decoding step: a single new token per sequence, without gradients
+    return (
+        hidden_states.shape[1] == 1
+        and hidden_states.is_cuda
+        and not torch.is_grad_enabled()
+        and not is_torchdynamo_compiling()
+    )
+
+
+def _graphed_decode_call(module: nn.Module, fn: Callable, *inputs: torch.Tensor) -> torch.Tensor:
     """
-    A mixed expert module containing shared experts.
+    Replays a CUDA graph of `fn(*inputs)`, captured once per input shape for `module`. Decoding steps all share the
+    same `(batch_size, 1, hidden_size)` shape, so the launches of the many small kernels are paid only once.
+
+    The graphs are kept out of `module`, which stays deep-copyable, and all of them allocate from a single memory pool
+    per device. They read the weights at the addresses they had during the capture, so they are captured again once
+    the weights of `module` are reallocated (moved, cast, reloaded...).
+    """
+    device = inputs[0].device
+    key = (inputs[0].shape, inputs[0].dtype, device)
+    weight_ptrs = tuple(param.data_ptr() for param in module.parameters())
+    captured_weight_ptrs, graphs = _DECODE_GRAPHS.get(module, (None, {}))
+    if captured_weight_ptrs != weight_ptrs or (key not in graphs and len(graphs) >= _MAX_DECODE_GRAPHS):
+        graphs = {}
+    _DECODE_GRAPHS[module] = (weight_ptrs, graphs)
+
+    if key not in graphs:
+        if device not in _DECODE_GRAPH_POOLS:
+            _DECODE_GRAPH_POOLS[device] = torch.cuda.graph_pool_handle()
+        static_inputs = tuple(tensor.clone() for tensor in inputs)
+        current_stream = torch.cuda.current_stream(device)
+        with torch.cuda.device(device):
+            # the warmup has to run on a side stream before the capture
+            warmup_stream = torch.cuda.Stream(device=device)
+            warmup_stream.wait_stream(current_stream)
+            with torch.cuda.stream(warmup_stream):
+                fn(*static_inputs)
+            current_stream.wait_stream(warmup_stream)
+
+            # sharing the pool is safe as the graphs are replayed one after the other, each output being copied out
+            # right after its replay
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph, pool=_DECODE_GRAPH_POOLS[device]):
+                static_output = fn(*static_inputs)
+        graphs[key] = (graph, static_inputs, static_output)
+
+    graph, static_inputs, static_output = graphs[key]
+    for static_input, tensor in zip(static_inputs, inputs):
+        static_input.copy_(tensor)
+    graph.replay()
+    # the static output is overwritten by the next replay
+    return static_output.clone()
+
+
+class DeepseekV3Int8Linear(nn.Module):
+    """
+    Int8 weight-only (W8A16) counterpart of a bias-free `nn.Linear`, with one scale per output row, used by the
+    quantized routed experts (see `DeepseekV3Experts.quantize`). Its weight is saved dequantized, under the `weight`
+    key of the `nn.Linear` it replaces, and quantized again when loaded with `load_state_dict`.
     """
 
-    def __init__(self, config):
+    def __init__(self, in_features: int, out_features: int, dtype: torch.dtype, device: Optional[torch.device] = None):
         super().__init__()
-        self.config = config
-        self.experts = nn.ModuleList(
+        self.in_features = in_features
+        self.out_features = out_features
+        # a frozen parameter rather than a buffer, so that the quantized weights are still counted as parameters
+        qweight = torch.empty(out_features, in_features, dtype=torch.int8, device=device)
+        self.qweight = nn.Parameter(qweight, requires_grad=False)
+        self.register_buffer("scale", torch.empty(out_features, dtype=dtype, device=device))
+        self._register_state_dict_hook(self._dequantize_state_dict)
+        self._register_load_state_dict_pre_hook(self._quantize_state_dict)
+
+    @staticmethod
+    @torch.no_grad()
+    def quantize_weight(weight: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        weight = weight.float()
+        scale = weight.abs().amax(dim=-1).clamp(min=1e-8) / 127
+        qweight = torch.round(weight / scale.unsqueeze(-1)).clamp(-128, 127).to(torch.int8)
+        return qweight, scale
+
+    @classmethod
+    def from_linear(cls, linear: nn.Linear) -> "DeepseekV3Int8Linear":
+        weight = linear.weight
+        module = cls(linear.in_features, linear.out_features, dtype=weight.dtype, device=weight.device)
+        qweight, scale = cls.quantize_weight(weight)
+        module.qweight.copy_(qweight)
+        module.scale.copy_(scale)
+        return module
+
+    def _dequantize_state_dict(self, module, state_dict, prefix, local_metadata):
+        qweight = state_dict.pop(f"{prefix}qweight")
+        scale = state_dict.pop(f"{prefix}scale")
+        state_dict[f"{prefix}weight"] = qweight.to(scale.dtype) * scale.unsqueeze(-1)
+
+    def _quantize_state_dict(self, state_dict, prefix, *args):
+        if f"{prefix}weight" in state_dict:
+            qweight, scale = self.quantize_weight(state_dict.pop(f"{prefix}weight"))
+            state_dict[f"{prefix}qweight"] = qweight
+            state_dict[f"{prefix}scale"] = scale.to(self.scale.dtype)
+
+    def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        if hidden_states.device.type != "cpu":
+            raise ValueError(f"The int8 experts can only run on CPU, got {hidden_states.device}.")
+        # dequantization is fused in the matmul
+        output = torch._weight_int8pack_mm(
+            hidden_states.reshape(-1, self.in_features), self.qweight, self.scale.to(hidden_states.dtype)
+        )
+        return output.view(*hidden_states.shape[:-1], self.out_features)
+
+
+class DeepseekV3Experts(nn.ModuleList):
+    """
+    The routed experts. Each of them is a `DeepseekV3MLP`, which keeps the layout of the original checkpoints and of
+    the quantization integrations (that replace `nn.Linear` layers). At inference, their weights are packed along a
+    leading `num_experts` dim, so that all the experts are dispatched with a few large GEMMs instead of a module call
+    each.
+    """
+
+    def __init__(self, config):
+        super().__init__(
             [
                 DeepseekV3MLP(config, intermediate_size=config.moe_intermediate_size)
                 for _ in range(config.n_routed_experts)
             ]
         )
+        self.num_experts = config.n_routed_experts
+        self.hidden_size = config.hidden_size
+        self.act_fn = ACT2FN[config.hidden_act]
+        self._packed_weights = None
+
+    def _apply(self, fn, recurse=True):
+        # moving or casting the experts reallocates their weights, they are packed again on the next forward
+        self._packed_weights = None
+        return super()._apply(fn, recurse)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        # loading with `assign=True` replaces the weights of the experts
+        self._packed_weights = None
+        super()._load_from_state_dict(*args, **kwargs)
+
+    @torch.no_grad()
+    def _pack_weights(self) -> Dict[str, torch.Tensor]:
+        layers = {proj: [getattr(expert, proj) for expert in self] for proj in ("gate_proj", "up_proj", "down_proj")}
+        for proj_layers in layers.values():
+            weight = proj_layers[0].weight
+            # quantized (e.g. FP8) and offloaded experts go through their own modules
+            if weight.device.type == "meta" or not weight.is_floating_point():
+                return {}
+            for layer in proj_layers:
+                if type(layer) is not nn.Linear or type(layer.weight.data) is not torch.Tensor:
+                    return {}
+                # e.g. the empty placeholders of sharded (ZeRO-3) parameters
+                if layer.weight.shape != (layer.out_features, layer.in_features):
+                    return {}
+                if layer.weight.device != weight.device or layer.weight.dtype != weight.dtype:
+                    return {}
+
+        packed_weights = {}
+        for proj, proj_layers in layers.items():
+            packed_weights[proj] = torch.stack([layer.weight.data for layer in proj_layers])
+            # the experts keep their parameters, as views of the packed weights: packing costs no extra memory
+            for expert_idx, layer in enumerate(proj_layers):
+                layer.weight.data = packed_weights[proj][expert_idx]
+        return packed_weights
+
+    def packed_weights(self) -> Optional[Dict[str, torch.Tensor]]:
+        """
+        Returns the `(num_experts, out_features, in_features)` weights of each projection, or `None` when they can't be
+        used: experts that can't be packed (quantized, offloaded...) or whose weights need gradients, as the packed
+        weights are plain tensors.
+        """
+        # checked before packing: the parameters of trained experts (possibly sharded, e.g. by ZeRO-3 or FSDP) are
+        # left untouched
+        if self.is_quantized or (torch.is_grad_enabled() and self[0].gate_proj.weight.requires_grad):
+            return None
+        if self._packed_weights is None:
+            self._packed_weights = self._pack_weights()
+        return self._packed_weights or None
+
+    @torch.no_grad()
+    def quantize(self):
+        """
+        Quantizes the experts to int8 weight-only (W8A16), replacing their projections with `DeepseekV3Int8Linear`.
+        The expert GEMMs are bound by the weight reads, so this halves their memory traffic. Meant for inference on
+        CPU, where the dequantization is fused in the matmul, once the weights are loaded. The experts are saved
+        dequantized, in the checkpoint layout: `from_pretrained` loads them unquantized, while `load_state_dict`
+        quantizes them again.
+        """
+        for expert in self:
+            for proj in ("gate_proj", "up_proj", "down_proj"):
+                layer = getattr(expert, proj)
+                if type(layer) is not nn.Linear or layer.weight.device.type == "meta":
+                    raise ValueError("Only experts with unquantized `nn.Linear` weights can be quantized.")
+        device = self[0].gate_proj.weight.device
+        if device.type != "cpu" or not hasattr(torch, "_weight_int8pack_mm"):
+            raise ValueError(
+                f"The int8 experts only have a fused kernel on CPU (with `torch._weight_int8pack_mm`), got {device}. "
+                "On accelerators, use `TorchAoConfig('int8_weight_only')` instead."
+            )
+        for expert in self:
+            for proj in ("gate_proj", "up_proj", "down_proj"):
+                setattr(expert, proj, DeepseekV3Int8Linear.from_linear(getattr(expert, proj)))
+        self._packed_weights = None
+
+    @property
+    def is_quantized(self) -> bool:
+        return isinstance(self[0].gate_proj, DeepseekV3Int8Linear)
+
+    def use_grouped_mm(self, hidden_states: torch.Tensor) -> bool:
+        return _can_use_grouped_mm(hidden_states) and self.packed_weights() is not None
+
+    def _batched_forward(
+        self, expert_inputs: Tuple[torch.Tensor], counts: List[int], packed_weights: Dict[str, torch.Tensor]
+    ) -> torch.Tensor:
+        # pad the inputs of all the experts to `(num_experts, max_tokens, hidden_size)`, so that each projection is
+        # a single batched GEMM against the packed weights instead of one GEMM per expert. The padded rows are dropped
+        # from the outputs.
+        padded_inputs = nn.utils.rnn.pad_sequence(expert_inputs, batch_first=True)
+        gate = torch.bmm(padded_inputs, packed_weights["gate_proj"].transpose(1, 2))
+        up = torch.bmm(padded_inputs, packed_weights["up_proj"].transpose(1, 2))
+        padded_outputs = torch.bmm(self.act_fn(gate) * up, packed_weights["down_proj"].transpose(1, 2))
+        return torch.cat([output[:count] for output, count in zip(padded_outputs, counts)], dim=0)
+
+    def forward(self, sorted_tokens: torch.Tensor, tokens_per_expert: torch.Tensor) -> torch.Tensor:
+        """
+        Runs the experts on `sorted_tokens`, which are expected to be grouped by expert, the i-th expert owning the
+        next `tokens_per_expert[i]` rows.
+        """
+        packed_weights = self.packed_weights()
+        if packed_weights is not None and _can_use_grouped_mm(sorted_tokens):
+            # a single grouped GEMM per projection instead of 3 small GEMMs per expert
+            offsets = torch.cumsum(tokens_per_expert, dim=0, dtype=torch.int32)
+            gate = torch._grouped_mm(sorted_tokens, packed_weights["gate_proj"].transpose(-2, -1), offs=offsets)
+            up = torch._grouped_mm(sorted_tokens, packed_weights["up_proj"].transpose(-2, -1), offs=offsets)
+            down_proj = packed_weights["down_proj"].transpose(-2, -1)
+            return torch._grouped_mm(self.act_fn(gate) * up, down_proj, offs=offsets)
+
+        # only visit the experts that received tokens, with top-k << num_experts most of them are idle
+        active_experts = torch.nonzero(tokens_per_expert, as_tuple=True)[0]
+        active_counts = tokens_per_expert[active_experts].tolist()
+        expert_inputs = sorted_tokens.split(active_counts)
+        # when every expert received tokens, the packed weights can be used as they are, without gathering the
+        # weights of the active experts. The padding is bounded to keep the wasted FLOPs in check.
+        padded_rows = len(active_counts) * max(active_counts, default=0)
+        all_active = len(active_counts) == self.num_experts
+        if packed_weights is not None and all_active and padded_rows <= 2 * sorted_tokens.shape[0]:
+            return self._batched_forward(expert_inputs, active_counts, packed_weights)
+
+        outputs = []
+        for expert_idx, expert_input in zip(active_experts.tolist(), expert_inputs):
+            outputs.append(self[expert_idx](expert_input))
+        return torch.cat(outputs, dim=0) if outputs else sorted_tokens.new_empty(0, self.hidden_size)
+
+
+class DeepseekV3MoE(nn.Module):
+    """
+    A mixed expert module containing shared experts.
+    """
+
+    def __init__(self, config):
+        super().__init__()
+        self.config = config
+        self.num_experts = config.n_routed_experts
+        self.experts = DeepseekV3Experts(config)
         self.gate = DeepseekV3TopkRouter(config)
         self.shared_experts = DeepseekV3MLP(
             config=config, intermediate_size=config.moe_intermediate_size * config.n_shared_experts
         )
+        # unlike the routed experts, the shared ones have the same shapes at every decoding step
+        self.graph_decode = config.cuda_graph_decode
 
     def moe(self, hidden_states: torch.Tensor, topk_indices: torch.Tensor, topk_weights: torch.Tensor):
-        r"""
-        CALL FOR CONTRIBUTION! I don't have time to optimise this right now, but expert weights need to be fused
-        to not have to do a loop here (deepseek has 256 experts soooo yeah).
-        """
-        final_hidden_states = torch.zeros_like(hidden_states, dtype=topk_weights.dtype)
-        expert_mask = torch.nn.functional.one_hot(topk_indices, num_classes=len(self.experts))
-        expert_mask = expert_mask.permute(2, 0, 1)
-
-        for expert_idx in range(len(self.experts)):
-            expert = self.experts[expert_idx]
-            mask = expert_mask[expert_idx]
-            token_indices, weight_indices = torch.where(mask)
-
-            if token_indices.numel() > 0:
-                expert_weights = topk_weights[token_indices, weight_indices]
-                expert_input = hidden_states[token_indices]
-                expert_output = expert(expert_input)
-                weighted_output = expert_output * expert_weights.unsqueeze(-1)
-                final_hidden_states.index_add_(0, token_indices, weighted_output)
+        # O(N * top_k) count instead of summing a (N, top_k, num_experts) one-hot mask. Unlike `torch.bincount`, which
+        # reads the min and max indices back on host, `scatter_add_` never syncs with the device
+        flat_indices = topk_indices.view(-1)
+        tokens_per_expert = flat_indices.new_zeros(self.num_experts).scatter_add_(
+            0, flat_indices, torch.ones_like(flat_indices)
+        )
+
+        copy_done = None
+        if tokens_per_expert.is_cuda and not self.experts.use_grouped_mm(hidden_states):
+            # the expert loop needs the counts on host: copy them asynchronously and only wait right before the loop,
+            # so that the sort and gather below are already queued on the device instead of stalling the stream
+            tokens_per_expert = tokens_per_expert.to("cpu", non_blocking=True)
+            copy_done = torch.cuda.Event()
+            copy_done.record(torch.cuda.current_stream(hidden_states.device))
+
+        # group the (token, expert) pairs by expert so that each expert reads a contiguous block of tokens
+        sorted_indices = flat_indices.argsort()
+        token_indices = sorted_indices // topk_indices.shape[-1]
+        sorted_tokens = hidden_states[token_indices]
+        if copy_done is not None:
+            copy_done.synchronize()
+        expert_outputs = self.experts(sorted_tokens, tokens_per_expert)
+
+        # weight the outputs and accumulate them straight into the row of their token: this undoes the sort and sums
+        # over the top-k experts at once, without materializing the outputs back in token order
+        sorted_weights = topk_weights.view(-1)[sorted_indices].unsqueeze(-1)
+        expert_outputs = expert_outputs.type(topk_weights.dtype) * sorted_weights
+        final_hidden_states = expert_outputs.new_zeros(hidden_states.shape[0], expert_outputs.shape[-1])
+        final_hidden_states.index_add_(0, token_indices, expert_outputs)
 
         # in original deepseek, the output of the experts are gathered once we leave this module
         # thus the moe module is itelsf an IsolatedParallel module
@@ -193,10 +518,30 @@ class DeepseekV3MoE(nn.Module):
     def forward(self, hidden_states):
         residuals = hidden_states
         orig_shape = hidden_states.shape
+
+        side_stream = None
+        if hidden_states.is_cuda and not is_torchdynamo_compiling():
+            # the shared experts don't depend on the routing: run them on a side stream, overlapping the routed ones
+            current_stream = torch.cuda.current_stream(hidden_states.device)
+            side_stream = _get_side_stream(hidden_states.device)
+            side_stream.wait_stream(current_stream)
+            with torch.cuda.stream(side_stream):
+                if self.graph_decode and _can_use_decode_graph(residuals):
+                    shared_output = _graphed_decode_call(self.shared_experts, self.shared_experts, residuals)
+                else:
+                    shared_output = self.shared_experts(residuals)
+            residuals.record_stream(side_stream)
+        else:
+            shared_output = self.shared_experts(residuals)
+
         topk_indices, topk_weights = self.gate(hidden_states)
         hidden_states = hidden_states.view(-1, hidden_states.shape[-1])
         hidden_states = self.moe(hidden_states, topk_indices, topk_weights).view(*orig_shape)
-        hidden_states = hidden_states + self.shared_experts(residuals)
+
+        if side_stream is not None:
+            current_stream.wait_stream(side_stream)
+            shared_output.record_stream(current_stream)
+        hidden_states = hidden_states + shared_output
         return hidden_states
 
 
@@ -249,6 +594,13 @@ class DeepseekV3Attention(nn.Module):
                 mscale = yarn_get_mscale(scaling_factor, mscale_all_dim)
                 self.scaling = self.scaling * mscale * mscale
 
+        # the other backends would up-project the whole cached latent at every decoding step
+        if config.use_mla_absorption and config._attn_implementation not in ("eager", "sdpa"):
+            raise ValueError(
+                "`use_mla_absorption=True` is only supported with the eager and sdpa attention implementations, got "
+                f"{config._attn_implementation}."
+            )
+
     def forward(
         self,
         hidden_states: torch.Tensor,
@@ -267,9 +619,7 @@ class DeepseekV3Attention(nn.Module):
 
         compressed_kv = self.kv_a_proj_with_mqa(hidden_states)
         k_pass, k_rot = torch.split(compressed_kv, [self.kv_lora_rank, self.qk_rope_head_dim], dim=-1)
-
-        k_pass = self.kv_b_proj(self.kv_a_layernorm(k_pass)).view(key_shape).transpose(1, 2)
-        k_pass, value_states = torch.split(k_pass, [self.qk_nope_head_dim, self.v_head_dim], dim=-1)
+        k_pass = self.kv_a_layernorm(k_pass)
 
         k_rot = k_rot.view(batch_size, 1, seq_length, self.qk_rope_head_dim)
 
@@ -278,17 +628,36 @@ class DeepseekV3Attention(nn.Module):
             q_rot, k_rot = apply_rotary_pos_emb_interleave(q_rot, k_rot, cos, sin)
         else:
             q_rot, k_rot = apply_rotary_pos_emb(q_rot, k_rot, cos, sin)
+
+        # sin and cos are specific to RoPE models; cache_position needed for the static cache
+        cache_kwargs = {"sin": sin, "cos": cos, "cache_position": cache_position}
+        if self.config.use_mla_absorption:
+            self._check_mla_absorption(past_key_value)
+            # only the compressed latent and the rotary key (shared by all heads) are cached
+            k_pass = k_pass.unsqueeze(1)
+            if past_key_value is not None:
+                k_pass, k_rot = past_key_value.update(k_pass, k_rot, self.layer_idx, cache_kwargs)
+            # decoding, or extending a cache (e.g. assisted decoding): only the prefill of an empty cache, which
+            # computes all the keys and values anyway, goes through the up-projection of the latent
+            if seq_length == 1 or k_pass.shape[-2] > seq_length:
+                return self.absorbed_attention(q_pass, q_rot, k_pass, k_rot, attention_mask)
+            k_pass = k_pass.squeeze(1)
+            key_shape = (batch_size, k_pass.shape[1], -1, self.qk_nope_head_dim + self.v_head_dim)
+
+        k_pass = self.kv_b_proj(k_pass).view(key_shape).transpose(1, 2)
+        k_pass, value_states = torch.split(k_pass, [self.qk_nope_head_dim, self.v_head_dim], dim=-1)
         k_rot = k_rot.expand(*k_pass.shape[:-1], -1)
 
         query_states = torch.cat((q_pass, q_rot), dim=-1)
         key_states = torch.cat((k_pass, k_rot), dim=-1)
 
-        if past_key_value is not None:
-            # sin and cos are specific to RoPE models; cache_position needed for the static cache
-            cache_kwargs = {"sin": sin, "cos": cos, "cache_position": cache_position}
+        if past_key_value is not None and not self.config.use_mla_absorption:
             key_states, value_states = past_key_value.update(key_states, value_states, self.layer_idx, cache_kwargs)
 
-        if self.config._attn_implementation == "flash_attention_2" and self.qk_head_dim != self.v_head_dim:
+        # flash attention needs the values to have the same head dim as the queries and keys. They are only padded for
+        # the attention call: the cache keeps `v_head_dim` values, which are smaller and shared by all the backends
+        pad_values = self.config._attn_implementation == "flash_attention_2" and self.qk_head_dim != self.v_head_dim
+        if pad_values:
             value_states = F.pad(value_states, [0, self.qk_head_dim - self.v_head_dim])
 
         attention_interface: Callable = eager_attention_forward
@@ -306,10 +675,63 @@ class DeepseekV3Attention(nn.Module):
             **kwargs,
         )
 
-        if self.config._attn_implementation == "flash_attention_2" and self.qk_head_dim != self.v_head_dim:
+        if pad_values:
             attn_output = attn_output[:, :, :, : self.v_head_dim]
 
-        attn_output = attn_output.reshape(batch_size, seq_length, -1).contiguous()
+        # `reshape` is a view on the contiguous attention outputs, it only copies (into a contiguous tensor) when the
+        # padded values were sliced out: no need for an extra `contiguous()` pass
+        attn_output = attn_output.reshape(batch_size, seq_length, -1)
+        attn_output = self.o_proj(attn_output)
+        return attn_output, attn_weights
+
+    def _check_mla_absorption(self, past_key_value: Optional[Cache]):
+        if past_key_value is not None and past_key_value.is_compileable:
+            raise ValueError(
+                "`use_mla_absorption=True` caches the compressed latent, which static caches don't support, got "
+                f"{type(past_key_value).__name__}. Use a `DynamicCache` instead."
+            )
+        # the absorbed attention reads the weights of `kv_b_proj` directly
+        if type(self.kv_b_proj) is not nn.Linear or self.kv_b_proj.weight.element_size() < 2:
+            raise ValueError(
+                "`use_mla_absorption=True` needs an unquantized `kv_b_proj`, got a "
+                f"{type(self.kv_b_proj).__name__} with {self.kv_b_proj.weight.dtype} weights."
+            )
+
+    def absorbed_attention(
+        self,
+        q_pass: torch.Tensor,
+        q_rot: torch.Tensor,
+        kv_latent: torch.Tensor,
+        k_rot: torch.Tensor,
+        attention_mask: Optional[torch.Tensor],
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Attention computed directly on the cached latent: the key up-projection of `kv_b_proj` is absorbed in the
+        query and its value up-projection is applied to the attention output, so per-head keys and values are never
+        materialized. With a single query token, this reads `kv_lora_rank + qk_rope_head_dim` values per cached token
+        instead of `num_heads * (qk_head_dim + v_head_dim)`.
+        """
+        batch_size, _, seq_length, _ = q_pass.shape
+        kv_b_weight = self.kv_b_proj.weight.view(self.num_heads, -1, self.kv_lora_rank)
+        w_uk, w_uv = torch.split(kv_b_weight, [self.qk_nope_head_dim, self.v_head_dim], dim=1)
+
+        q_pass = torch.einsum("bhsd,hdr->bhsr", q_pass, w_uk)
+        attn_weights = torch.matmul(q_pass, kv_latent.transpose(2, 3)) + torch.matmul(q_rot, k_rot.transpose(2, 3))
+        attn_weights = attn_weights * self.scaling
+        if attention_mask is not None:
+            causal_mask = attention_mask[:, :, :, : kv_latent.shape[-2]]
+            if causal_mask.dtype == torch.bool:
+                attn_weights = attn_weights.masked_fill(~causal_mask, torch.finfo(attn_weights.dtype).min)
+            else:
+                attn_weights = attn_weights + causal_mask
+
+        attn_weights = nn.functional.softmax(attn_weights, dim=-1, dtype=torch.float32).to(q_pass.dtype)
+        dropout = 0.0 if not self.training else self.attention_dropout
+        attn_weights = nn.functional.dropout(attn_weights, p=dropout, training=self.training)
+        attn_output = torch.matmul(attn_weights, kv_latent)
+        attn_output = torch.einsum("bhsr,hdr->bshd", attn_output, w_uv)
+
+        attn_output = attn_output.reshape(batch_size, seq_length, -1)
         attn_output = self.o_proj(attn_output)
         return attn_output, attn_weights
 
@@ -328,6 +750,72 @@ class DeepseekV3DecoderLayer(LlamaDecoderLayer, nn.Module):
 
         self.input_layernorm = DeepseekV3RMSNorm(config.hidden_size, eps=config.rms_norm_eps)
         self.post_attention_layernorm = DeepseekV3RMSNorm(config.hidden_size, eps=config.rms_norm_eps)
+        # MoE layers are left out, their data-dependent routing would keep recompiling
+        self.compile_dense_block = config.compile_dense_layers and layer_idx < config.first_k_dense_replace
+        # the MoE layers only graph their shared experts, see `DeepseekV3MoE`
+        self.graph_decode = config.cuda_graph_decode and layer_idx < config.first_k_dense_replace
+
+    def dense_mlp(self, hidden_states: torch.Tensor, residual: torch.Tensor) -> torch.Tensor:
+        hidden_states = residual + hidden_states
+        return hidden_states + self.mlp(self.post_attention_layernorm(hidden_states))
+
+    @torch.compile(dynamic=True)
+    def compiled_input_layernorm(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        return self.input_layernorm(hidden_states)
+
+    @torch.compile(dynamic=True)
+    def compiled_mlp(self, hidden_states: torch.Tensor, residual: torch.Tensor) -> torch.Tensor:
+        return self.dense_mlp(hidden_states, residual)
+
+    def forward(
+        self,
+        hidden_states: torch.Tensor,
+        attention_mask: Optional[torch.Tensor] = None,
+        position_ids: Optional[torch.LongTensor] = None,
+        past_key_value: Optional[Cache] = None,
+        output_attentions: Optional[bool] = False,
+        use_cache: Optional[bool] = False,
+        cache_position: Optional[torch.LongTensor] = None,
+        position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,  # necessary, but kept here for BC
+        **kwargs: Unpack[FlashAttentionKwargs],
+    ) -> Tuple[torch.FloatTensor, Optional[Tuple[torch.FloatTensor, torch.FloatTensor]]]:
+        residual = hidden_states
+        if self.compile_dense_block:
+            hidden_states = self.compiled_input_layernorm(hidden_states)
+        else:
+            hidden_states = self.input_layernorm(hidden_states)
+
+        # Self Attention
+        hidden_states, self_attn_weights = self.self_attn(
+            hidden_states=hidden_states,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_value=past_key_value,
+            output_attentions=output_attentions,
+            use_cache=use_cache,
+            cache_position=cache_position,
+            position_embeddings=position_embeddings,
+            **kwargs,
+        )
+        if self.graph_decode and use_cache and _can_use_decode_graph(hidden_states):
+            mlp_fn = self.compiled_mlp if self.compile_dense_block else self.dense_mlp
+            hidden_states = _graphed_decode_call(self, mlp_fn, hidden_states, residual)
+        elif self.compile_dense_block:
+            hidden_states = self.compiled_mlp(hidden_states, residual)
+        else:
+            hidden_states = residual + hidden_states
+
+            # Fully Connected
+            residual = hidden_states
+            hidden_states = self.post_attention_layernorm(hidden_states)
+            hidden_states = self.mlp(hidden_states)
+            hidden_states = residual + hidden_states
+
+        outputs = (hidden_states,)
+        if output_attentions:
+            outputs += (self_attn_weights,)
+
+        return outputs
 
 
 class DeepseekV3PreTrainedModel(LlamaPreTrainedModel):
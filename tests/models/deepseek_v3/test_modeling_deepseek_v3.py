@@ -13,7 +13,11 @@
 # limitations under the License.
 """Testing suite for the PyTorch DeepseekV3 model."""
 
+import copy
+import os
+import tempfile
 import unittest
+from unittest.mock import patch
 
 from packaging import version
 from parameterized import parameterized
@@ -24,6 +28,7 @@ from transformers.testing_utils import (
     require_read_token,
     require_torch,
     require_torch_accelerator,
+    require_torch_gpu,
     require_torch_sdpa,
     slow,
     torch_device,
@@ -37,13 +42,21 @@ from ...test_pipeline_mixin import PipelineTesterMixin
 
 if is_torch_available():
     import torch
+    from safetensors.torch import load_file
 
     from transformers import (
         DeepseekV3ForCausalLM,
         DeepseekV3Model,
     )
+    from transformers.integrations import fused_apply_rotary_pos_emb_interleave, fused_silu_mul
     from transformers.models.deepseek_v3.modeling_deepseek_v3 import (
+        _DECODE_GRAPHS,
+        DeepseekV3Attention,
+        DeepseekV3Experts,
+        DeepseekV3MoE,
         DeepseekV3RotaryEmbedding,
+        DeepseekV3TopkRouter,
+        apply_rotary_pos_emb_interleave,
     )
 
 
@@ -425,6 +438,210 @@ class DeepseekV3ModelTest(ModelTesterMixin, GenerationTesterMixin, PipelineTeste
         with self.assertRaises(AssertionError):
             torch.testing.assert_close(yarn_sin_long, original_sin_long)
 
+    def test_rotary_embedding_dim(self):
+        # MLA only rotates the `qk_rope_head_dim` channels, cos and sin should not be sized after the full head dim
+        config, _ = self.model_tester.prepare_config_and_inputs_for_common()
+        rotary_emb = DeepseekV3RotaryEmbedding(config=config)
+        self.assertEqual(rotary_emb.inv_freq.shape[-1], config.qk_rope_head_dim // 2)
+
+        x = torch.randn(1, dtype=torch.float32)
+        position_ids = torch.arange(3).unsqueeze(0)
+        cos, sin = rotary_emb(x, position_ids)
+        self.assertEqual(cos.shape, (1, 3, config.qk_rope_head_dim))
+        self.assertEqual(sin.shape, (1, 3, config.qk_rope_head_dim))
+
+    def test_mla_absorption(self):
+        config, inputs_dict = self.model_tester.prepare_config_and_inputs_for_common()
+        input_ids = inputs_dict["input_ids"]
+        model = DeepseekV3ForCausalLM(config).to(torch_device).eval()
+
+        with torch.no_grad():
+            past_key_values = model(input_ids[:, :-1], use_cache=True).past_key_values
+            expected_logits = model(input_ids[:, -1:], past_key_values=past_key_values).logits
+
+            model.config.use_mla_absorption = True
+            past_key_values = model(input_ids[:, :-1], use_cache=True).past_key_values
+            # only the latent and the rotary key are cached
+            self.assertEqual(past_key_values[0][0].shape[-1], config.kv_lora_rank)
+            self.assertEqual(past_key_values[0][1].shape[-1], config.qk_rope_head_dim)
+            logits = model(input_ids[:, -1:], past_key_values=past_key_values).logits
+            torch.testing.assert_close(logits, expected_logits, rtol=1e-4, atol=1e-4)
+
+            # several new tokens on top of a cache (e.g. assisted decoding) also attend to the latent
+            model.config.use_mla_absorption = False
+            past_key_values = model(input_ids[:, :-3], use_cache=True).past_key_values
+            expected_logits = model(input_ids[:, -3:], past_key_values=past_key_values).logits
+            model.config.use_mla_absorption = True
+            past_key_values = model(input_ids[:, :-3], use_cache=True).past_key_values
+            logits = model(input_ids[:, -3:], past_key_values=past_key_values).logits
+            torch.testing.assert_close(logits, expected_logits, rtol=1e-4, atol=1e-4)
+
+            with self.assertRaises(ValueError):
+                model.generate(input_ids, cache_implementation="static", max_new_tokens=2)
+
+        config.use_mla_absorption = True
+        config._attn_implementation = "flash_attention_2"
+        with self.assertRaises(ValueError):
+            DeepseekV3Attention(config, layer_idx=0)
+
+    def test_quantize_experts(self):
+        config, inputs_dict = self.model_tester.prepare_config_and_inputs_for_common()
+        inputs_dict = {key: value.cpu() for key, value in inputs_dict.items()}
+        # the fused int8 kernel is only available on CPU
+        model = DeepseekV3ForCausalLM(config).eval()
+
+        num_parameters = model.num_parameters()
+
+        with torch.no_grad():
+            expected_logits = model(**inputs_dict).logits
+            for module in model.modules():
+                if isinstance(module, DeepseekV3Experts):
+                    module.quantize()
+                    self.assertEqual(module[0].gate_proj.qweight.dtype, torch.int8)
+            logits = model(**inputs_dict).logits
+        torch.testing.assert_close(logits, expected_logits, rtol=1e-2, atol=1e-2)
+        self.assertEqual(model.num_parameters(), num_parameters)
+
+        # the dequantized state dict is quantized again when loaded
+        model.load_state_dict(model.state_dict())
+        with torch.no_grad():
+            torch.testing.assert_close(model(**inputs_dict).logits, logits, rtol=1e-3, atol=1e-3)
+
+        # the experts are saved dequantized, in the checkpoint layout
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            model.save_pretrained(tmpdirname)
+            new_model, loading_info = DeepseekV3ForCausalLM.from_pretrained(tmpdirname, output_loading_info=True)
+            self.assertEqual(len(loading_info["missing_keys"]), 0)
+            self.assertEqual(len(loading_info["unexpected_keys"]), 0)
+
+        with torch.no_grad():
+            torch.testing.assert_close(new_model.eval()(**inputs_dict).logits, logits, rtol=1e-2, atol=1e-2)
+
+    def test_router_masks_dropped_groups(self):
+        config, _ = self.model_tester.prepare_config_and_inputs_for_common()
+        config.n_routed_experts, config.n_group, config.topk_group, config.num_experts_per_tok = 8, 2, 1, 2
+        router = DeepseekV3TopkRouter(config)
+        # every bias-corrected score is negative: the experts of the dropped group must not win with a 0 fill value
+        router.e_score_correction_bias.fill_(-1.0)
+        scores = torch.tensor([[0.9, 0.8, 0.1, 0.1, 0.2, 0.2, 0.2, 0.2]])
+
+        topk_indices = router.get_topk_indices(scores)
+        self.assertEqual(topk_indices.sort(dim=-1)[0].tolist(), [[0, 1]])
+
+    def test_experts_batched_forward(self):
+        config, _ = self.model_tester.prepare_config_and_inputs_for_common()
+        experts = DeepseekV3Experts(config).to(torch_device).eval()
+
+        # every expert received tokens, with little padding (16 padded rows for 15 tokens): the batched GEMMs are used
+        tokens_per_expert = torch.tensor([2, 2, 2, 2, 2, 2, 2, 1])[: config.n_routed_experts]
+        sorted_tokens = torch.randn(int(tokens_per_expert.sum()), config.hidden_size, device=torch_device)
+        expert_inputs = sorted_tokens.split(tokens_per_expert.tolist())
+
+        with torch.no_grad():
+            expected_outputs = torch.cat([expert(inputs) for expert, inputs in zip(experts, expert_inputs)])
+            with patch.object(experts, "_batched_forward", wraps=experts._batched_forward) as batched_forward:
+                outputs = experts(sorted_tokens, tokens_per_expert)
+        # fp32 inputs never take the (bf16 only) grouped GEMMs
+        batched_forward.assert_called_once()
+        torch.testing.assert_close(outputs, expected_outputs, rtol=1e-5, atol=1e-5)
+
+    def test_load_per_expert_checkpoint(self):
+        config, inputs_dict = self.model_tester.prepare_config_and_inputs_for_common()
+        model = DeepseekV3ForCausalLM(config).to(torch_device).eval()
+        with torch.no_grad():
+            # the first forward packs the weights of the experts, they still have to be saved one by one
+            expected_logits = model(**inputs_dict).logits
+
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            model.save_pretrained(tmpdirname)
+            # original checkpoints store one `DeepseekV3MLP` per routed expert
+            checkpoint_keys = load_file(os.path.join(tmpdirname, "model.safetensors")).keys()
+            moe_layer_idx = config.first_k_dense_replace
+            for expert_idx in range(config.n_routed_experts):
+                for proj in ("gate_proj", "up_proj", "down_proj"):
+                    key = f"model.layers.{moe_layer_idx}.mlp.experts.{expert_idx}.{proj}.weight"
+                    self.assertIn(key, checkpoint_keys)
+
+            new_model, loading_info = DeepseekV3ForCausalLM.from_pretrained(tmpdirname, output_loading_info=True)
+            self.assertEqual(len(loading_info["missing_keys"]), 0)
+            self.assertEqual(len(loading_info["unexpected_keys"]), 0)
+
+        new_model.to(torch_device).eval()
+        with torch.no_grad():
+            torch.testing.assert_close(new_model(**inputs_dict).logits, expected_logits)
+
+    def test_experts_not_packed_in_training(self):
+        config, inputs_dict = self.model_tester.prepare_config_and_inputs_for_common()
+        model = DeepseekV3ForCausalLM(config).to(torch_device).train()
+        experts = model.model.layers[config.first_k_dense_replace].mlp.experts
+        weight_ptr = experts[0].gate_proj.weight.data_ptr()
+
+        model(**inputs_dict, labels=inputs_dict["input_ids"]).loss.backward()
+        # the trained parameters keep their own storage
+        self.assertIsNone(experts._packed_weights)
+        self.assertEqual(experts[0].gate_proj.weight.data_ptr(), weight_ptr)
+
+    @require_torch_gpu
+    def test_cuda_graph_decode(self):
+        config, inputs_dict = self.model_tester.prepare_config_and_inputs_for_common()
+        input_ids = inputs_dict["input_ids"].to(torch_device)
+        model = DeepseekV3ForCausalLM(config).to(torch_device).eval()
+
+        with torch.no_grad():
+            past_key_values = model(input_ids[:, :-2], use_cache=True).past_key_values
+            expected_logits = model(input_ids[:, -2:-1], past_key_values=past_key_values).logits
+
+            graphed_modules = []
+            for layer in model.model.layers:
+                if isinstance(layer.mlp, DeepseekV3MoE):
+                    layer.mlp.graph_decode = True
+                    graphed_modules.append(layer.mlp.shared_experts)
+                else:
+                    layer.graph_decode = True
+                    graphed_modules.append(layer)
+            past_key_values = model(input_ids[:, :-2], use_cache=True).past_key_values
+            # the first step captures the graphs, the second one replays them
+            logits = model(input_ids[:, -2:-1], past_key_values=past_key_values).logits
+            model(input_ids[:, -1:], past_key_values=past_key_values)
+            for module in graphed_modules:
+                self.assertEqual(len(_DECODE_GRAPHS[module][1]), 1)
+            torch.testing.assert_close(logits, expected_logits, rtol=1e-4, atol=1e-4)
+
+            # the graphs are kept out of the model, which can still be copied
+            copy.deepcopy(model)
+
+            # reallocating the weights captures the graphs again
+            model.cpu().to(torch_device)
+            past_key_values = model(input_ids[:, :-2], use_cache=True).past_key_values
+            logits = model(input_ids[:, -2:-1], past_key_values=past_key_values).logits
+            torch.testing.assert_close(logits, expected_logits, rtol=1e-4, atol=1e-4)
+
+    @require_torch_gpu
+    def test_fused_rotary_pos_emb_interleave(self):
+        config, _ = self.model_tester.prepare_config_and_inputs_for_common()
+        batch_size, seq_length = 2, 5
+        q = torch.randn(batch_size, config.num_attention_heads, seq_length, config.qk_rope_head_dim)
+        k = torch.randn(batch_size, 1, seq_length, config.qk_rope_head_dim)
+        x = torch.randn(1, dtype=torch.float32)  # used exlusively to get the dtype and the device
+        position_ids = torch.arange(seq_length).unsqueeze(0).expand(batch_size, -1)
+        cos, sin = DeepseekV3RotaryEmbedding(config=config)(x, position_ids)
+
+        expected_q, expected_k = apply_rotary_pos_emb_interleave(q, k, cos, sin)
+        fused_q, fused_k = fused_apply_rotary_pos_emb_interleave(
+            q.to(torch_device), k.to(torch_device), cos.to(torch_device), sin.to(torch_device)
+        )
+        torch.testing.assert_close(fused_q.cpu(), expected_q, rtol=1e-5, atol=1e-5)
+        torch.testing.assert_close(fused_k.cpu(), expected_k, rtol=1e-5, atol=1e-5)
+
+    @require_torch_gpu
+    def test_fused_silu_mul(self):
+        config, _ = self.model_tester.prepare_config_and_inputs_for_common()
+        gate = torch.randn(2, 5, config.intermediate_size, device=torch_device)
+        up = torch.randn(2, 5, config.intermediate_size, device=torch_device)
+
+        expected_output = torch.nn.functional.silu(gate) * up
+        torch.testing.assert_close(fused_silu_mul(gate, up), expected_output, rtol=1e-5, atol=1e-5)
+
     def test_past_key_values_format(self):
         """
         Overwriting to pass the expected cache shapes (Deepseek-V3 uses MLA so the cache shapes are non-standard)